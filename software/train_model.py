@@ -12,16 +12,24 @@ This script:
 
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.collections import PatchCollection
+from matplotlib.patches import Rectangle
 import seaborn as sns
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LinearRegression
-from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
+from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.inspection import permutation_importance
 from sklearn.preprocessing import StandardScaler
-from sklearn.impute import SimpleImputer
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import joblib
 import argparse
+import copy
 import os
 
 # Configuration
@@ -29,80 +37,155 @@ plt.style.use('ggplot')
 pd.set_option('display.max_columns', 10)
 sns.set_palette('colorblind')
 
+# Static Clarke Error Grid zones as (x0, y0, width, height, color), built
+# once and copied onto each grid plot
+CLARKE_ZONE_RECTS = [
+    (0, 0, 70, 70, 'green'),        # Zone A
+    (70, 70, 110, 110, 'green'),
+    (180, 180, 220, 220, 'green'),
+    (0, 70, 70, 110, 'yellow'),     # Zone B
+    (70, 0, 110, 70, 'yellow'),
+    (70, 180, 110, 220, 'yellow'),
+    (180, 0, 220, 180, 'yellow'),
+]
+CLARKE_ZONES = PatchCollection(
+    [Rectangle((x0, y0), w, h) for x0, y0, w, h, _ in CLARKE_ZONE_RECTS],
+    facecolors=[c for *_, c in CLARKE_ZONE_RECTS],
+    edgecolors=[c for *_, c in CLARKE_ZONE_RECTS],
+    alpha=0.1
+)
+
+# Columns read from training CSVs; anything else is dropped at parse time.
+# Types are fixed up front so no per-file inference is needed. timestamp is
+# parsed as float64 so files that write it as e.g. 1689291000000.0 still
+# load; it is cast to int64 once nulls are removed.
+REQUIRED_COLUMNS = ['timestamp', 'ratio', 'variability', 'slope', 'glucose']
+VALUE_COLUMNS = REQUIRED_COLUMNS[1:]
+CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    include_columns=REQUIRED_COLUMNS,
+    column_types={'timestamp': pa.float64(), **{col: pa.float32() for col in VALUE_COLUMNS}}
+)
+
+def read_training_csv(file_path):
+    """
+    Read the required columns of a training CSV into an int64 timestamp
+    array and a float32 array of the remaining columns
+    """
+    try:
+        table = pacsv.read_csv(file_path, convert_options=CSV_CONVERT_OPTIONS)
+    except KeyError as e:
+        raise ValueError(f"Missing required columns in {file_path}: {e}") from e
+    except pa.ArrowInvalid as e:
+        raise ValueError(f"Invalid values in {file_path}: {e}") from e
+    # timestamp is the record key, so rows without one cannot be kept
+    missing_ts = table.column('timestamp').null_count
+    if missing_ts:
+        table = table.filter(pc.is_valid(table.column('timestamp')))
+        print(f"Dropped {missing_ts} records without timestamp from {file_path}")
+    try:
+        timestamps = pc.cast(table.column('timestamp'), pa.int64()).to_numpy()
+    except pa.ArrowInvalid as e:
+        raise ValueError(f"Non-integer timestamps in {file_path}: {e}") from e
+    values = np.column_stack([table.column(col).to_numpy() for col in VALUE_COLUMNS])
+    return timestamps, values
+
 def load_data(data_path):
     """
     Load and preprocess training data from CSV files
     """
     if os.path.isdir(data_path):
         # Load all CSV files in directory
-        files = [f for f in os.listdir(data_path) if f.endswith('.csv')]
-        dfs = []
+        files = [f for f in sorted(os.listdir(data_path)) if f.endswith('.csv')]
+        timestamps, arrays = [], []
         for file in files:
             file_path = os.path.join(data_path, file)
             try:
-                df = pd.read_csv(file_path)
-                dfs.append(df)
-                print(f"Loaded {file} with {len(df)} records")
+                ts, arr = read_training_csv(file_path)
+                timestamps.append(ts)
+                arrays.append(arr)
+                print(f"Loaded {file} with {len(arr)} records")
             except Exception as e:
                 print(f"Error loading {file}: {str(e)}")
         
-        if not dfs:
+        if not arrays:
             raise ValueError("No valid CSV files found in directory")
             
-        data = pd.concat(dfs, ignore_index=True)
+        timestamps = np.concatenate(timestamps)
+        values = np.concatenate(arrays, axis=0)
     else:
         # Load single file
-        data = pd.read_csv(data_path)
-        print(f"Loaded single file with {len(data)} records")
+        timestamps, values = read_training_csv(data_path)
+        print(f"Loaded single file with {len(values)} records")
     
-    # Check required columns
-    required_cols = {'timestamp', 'ratio', 'variability', 'slope', 'glucose'}
-    if not required_cols.issubset(data.columns):
-        missing = required_cols - set(data.columns)
-        raise ValueError(f"Missing required columns: {missing}")
+    data = pd.DataFrame(values, columns=VALUE_COLUMNS, copy=False)
+    data.insert(0, 'timestamp', timestamps)
     
     # Initial preprocessing
-    data = data.drop_duplicates()
     data = data.dropna(subset=['glucose'])  # Must have glucose values
+    data = data.drop_duplicates(subset=['timestamp'], keep='last')  # timestamp is the record key
     
     print(f"\nRaw data summary ({len(data)} records):")
     print(data[['ratio', 'variability', 'slope', 'glucose']].describe().round(2))
     
     return data
 
-def preprocess_data(data):
+# Column layout of the array handled by _preprocess_array
+PREPROCESS_INPUTS = ['ratio', 'variability', 'slope', 'glucose']
+PREPROCESS_OUTPUTS = PREPROCESS_INPUTS + ['pulse_rate', 'acdc_ratio']
+
+def _preprocess_array(arr, factor=1.5):
     """
-    Clean and preprocess the dataset
+    Impute, range-filter, IQR-filter and derive features for a
+    (ratio, variability, slope, glucose) array without pandas round trips.
+    Returns the processed rows and the boolean mask of rows kept.
     """
-    # Handle missing values
-    imputer = SimpleImputer(strategy='median')
-    data[['ratio', 'variability', 'slope']] = imputer.fit_transform(
-        data[['ratio', 'variability', 'slope']]
-    )
+    # Handle missing values (sensor columns only, in place)
+    sensors = arr[:, :3]
+    missing = np.isnan(sensors)
+    if missing.any():
+        med = np.nanmedian(sensors, axis=0)
+        sensors[missing] = np.take(med, np.nonzero(missing)[1])
     
     # Remove physiologically impossible glucose values
-    data = data[(data['glucose'] >= 40) & (data['glucose'] <= 400)]
-    
-    # Calculate additional features
-    data['pulse_rate'] = 60 / (data['variability'] + 1e-6)  # Approximate pulse rate
-    data['acdc_ratio'] = data['variability'] / data['ratio']  # AC/DC component ratio
-    
-    # Remove outliers using IQR method
-    def remove_outliers(df, columns, factor=1.5):
-        for col in columns:
-            q1 = df[col].quantile(0.25)
-            q3 = df[col].quantile(0.75)
-            iqr = q3 - q1
-            df = df[(df[col] >= q1 - factor*iqr) & (df[col] <= q3 + factor*iqr)]
-        return df
-    
-    data = remove_outliers(data, ['ratio', 'variability', 'slope', 'glucose'])
+    mask = (arr[:, 3] >= 40) & (arr[:, 3] <= 400)
+    if not mask.any():
+        raise ValueError("No records with glucose in the 40-400 mg/dL range")
+    
+    # Remove outliers using IQR method on the remaining rows
+    q1, q3 = np.percentile(arr[mask], [25, 75], axis=0)
+    iqr = q3 - q1
+    mask &= ((arr >= q1 - factor*iqr) & (arr <= q3 + factor*iqr)).all(axis=1)
+    
+    # Calculate additional features for the rows that survive
+    out = np.empty((np.count_nonzero(mask), len(PREPROCESS_OUTPUTS)), dtype=arr.dtype)
+    out[:, :4] = arr[mask]
+    v = out[:, 1]
+    r = out[:, 0]
+    np.divide(60.0, v + 1e-6, out=out[:, 4])  # Approximate pulse rate
+    np.divide(v, r, out=out[:, 5])            # AC/DC component ratio
+    return out, mask
+
+def preprocess_data(data):
+    """
+    Clean and preprocess the dataset
+    """
+    arr = data[PREPROCESS_INPUTS].to_numpy(dtype=np.float32, copy=True)
+    out, mask = _preprocess_array(arr)
+    data = data[mask].assign(**dict(zip(PREPROCESS_OUTPUTS, out.T)))
     
     print(f"\nProcessed data summary ({len(data)} records):")
-    print(data[['ratio', 'variability', 'slope', 'glucose', 'pulse_rate', 'acdc_ratio']].describe().round(2))
+    print(data[PREPROCESS_OUTPUTS].describe().round(2))
     
     return data
 
+def standardize_inplace(X, mean, inv_scale):
+    """
+    Standardize a writable feature matrix in place with cached scaler stats
+    """
+    np.subtract(X, mean, out=X)
+    np.multiply(X, inv_scale, out=X)
+    return X
+
 def train_model(X_train, y_train, model_type='linear'):
     """
     Train specified regression model
@@ -115,13 +198,16 @@ def train_model(X_train, y_train, model_type='linear'):
         model = RandomForestRegressor(
             n_estimators=100,
             max_depth=5,
-            random_state=42
+            random_state=42,
+            n_jobs=-1
         )
     elif model_type == 'gradient_boosting':
-        model = GradientBoostingRegressor(
-            n_estimators=100,
+        model = HistGradientBoostingRegressor(
+            max_iter=100,
             learning_rate=0.1,
             max_depth=3,
+            min_samples_leaf=1,     # match the exact-split trees it replaced
+            early_stopping=False,   # always fit max_iter trees
             random_state=42
         )
     else:
@@ -130,9 +216,21 @@ def train_model(X_train, y_train, model_type='linear'):
     model.fit(X_train, y_train)
     return model
 
-def evaluate_model(model, X_test, y_test):
+def reset_figure(ax, figsize):
     """
-    Evaluate model performance and generate metrics
+    Clear a reused axes and restore the default figure geometry
+    """
+    ax.cla()
+    ax.figure.set_size_inches(figsize)
+    ax.figure.subplots_adjust(**{
+        side: plt.rcParams[f'figure.subplot.{side}']
+        for side in ('left', 'bottom', 'right', 'top')
+    })
+
+def evaluate_model(model, X_test, y_test, feature_names, ax):
+    """
+    Evaluate model performance and generate metrics, drawing every plot on
+    the shared axes
     """
     y_pred = model.predict(X_test)
     
@@ -141,57 +239,60 @@ def evaluate_model(model, X_test, y_test):
     rmse = np.sqrt(mean_squared_error(y_test, y_pred))
     r2 = r2_score(y_test, y_pred)
     
+    title = model.__class__.__name__
+    fig = ax.figure
+    
     # Clarke Error Grid Analysis
     def clarke_error_grid(ref, pred, title):
-        plt.figure(figsize=(10, 8))
-        plt.scatter(ref, pred, alpha=0.5)
-        plt.plot([0, 400], [0, 400], 'k--')
-        plt.plot([0, 175/3], [70, 70], 'r-')  # Hypoglycemia threshold
-        plt.plot([70, 70], [0, 180], 'r-')    # Hypoglycemia threshold
-        plt.plot([180, 400], [180, 180], 'r-') # Hyperglycemia threshold
-        plt.plot([180, 180], [0, 400], 'r-')   # Hyperglycemia threshold
+        reset_figure(ax, (10, 8))
+        ax.scatter(ref, pred, alpha=0.5)
+        ax.plot([0, 400], [0, 400], 'k--')
+        ax.plot([0, 175/3], [70, 70], 'r-')  # Hypoglycemia threshold
+        ax.plot([70, 70], [0, 180], 'r-')    # Hypoglycemia threshold
+        ax.plot([180, 400], [180, 180], 'r-') # Hyperglycemia threshold
+        ax.plot([180, 180], [0, 400], 'r-')   # Hyperglycemia threshold
         
         # Add zones
-        plt.fill_between([0, 70], 0, 70, color='green', alpha=0.1)  # Zone A
-        plt.fill_between([70, 180], 70, 180, color='green', alpha=0.1)
-        plt.fill_between([180, 400], 180, 400, color='green', alpha=0.1)
-        plt.fill_between([0, 70], 70, 180, color='yellow', alpha=0.1)  # Zone B
-        plt.fill_between([70, 180], 0, 70, color='yellow', alpha=0.1)
-        plt.fill_between([70, 180], 180, 400, color='yellow', alpha=0.1)
-        plt.fill_between([180, 400], 0, 180, color='yellow', alpha=0.1)
+        ax.add_collection(copy.copy(CLARKE_ZONES))
         
-        plt.title(f'Clarke Error Grid: {title}')
-        plt.xlabel('Reference Glucose (mg/dL)')
-        plt.ylabel('Predicted Glucose (mg/dL)')
-        plt.grid(True)
-        plt.savefig(f'clarke_grid_{title}.png', dpi=300)
-        plt.close()
+        ax.set_title(f'Clarke Error Grid: {title}')
+        ax.set_xlabel('Reference Glucose (mg/dL)')
+        ax.set_ylabel('Predicted Glucose (mg/dL)')
+        ax.grid(True)
+        fig.savefig(f'clarke_grid_{title}.png', dpi=300)
     
-    clarke_error_grid(y_test, y_pred, model.__class__.__name__)
+    clarke_error_grid(y_test, y_pred, title)
     
     # Residual plot
     residuals = y_test - y_pred
-    plt.figure(figsize=(10, 6))
-    sns.scatterplot(x=y_pred, y=residuals, alpha=0.5)
-    plt.axhline(y=0, color='r', linestyle='-')
-    plt.title('Residual Plot')
-    plt.xlabel('Predicted Glucose (mg/dL)')
-    plt.ylabel('Residuals')
-    plt.savefig(f'residuals_{model.__class__.__name__}.png', dpi=300)
-    plt.close()
+    reset_figure(ax, (10, 6))
+    # White marker edges as drawn by the seaborn scatterplot this replaced
+    ax.scatter(y_pred, residuals, alpha=0.5, edgecolors='w', linewidths=0.48)
+    ax.axhline(y=0, color='r', linestyle='-')
+    ax.set_title('Residual Plot')
+    ax.set_xlabel('Predicted Glucose (mg/dL)')
+    ax.set_ylabel('Residuals')
+    fig.savefig(f'residuals_{title}.png', dpi=300)
     
     # Feature importance
+    importances = None
     if hasattr(model, 'feature_importances_'):
-        plt.figure(figsize=(10, 6))
-        features = X_test.columns
         importances = model.feature_importances_
+    elif isinstance(model, HistGradientBoostingRegressor):
+        # No impurity-based importances; measure them on the test split
+        importances = permutation_importance(
+            model, X_test, y_test, n_repeats=10, random_state=42, n_jobs=-1
+        ).importances_mean
+    
+    if importances is not None:
+        reset_figure(ax, (10, 6))
         indices = np.argsort(importances)[::-1]
-        plt.title('Feature Importances')
-        plt.bar(range(len(importances)), importances[indices], align='center')
-        plt.xticks(range(len(importances)), [features[i] for i in indices], rotation=45)
-        plt.tight_layout()
-        plt.savefig(f'feature_importance_{model.__class__.__name__}.png', dpi=300)
-        plt.close()
+        ax.set_title('Feature Importances')
+        ax.bar(range(len(importances)), importances[indices], align='center')
+        ax.set_xticks(range(len(importances)))
+        ax.set_xticklabels([feature_names[i] for i in indices], rotation=45)
+        fig.tight_layout()
+        fig.savefig(f'feature_importance_{title}.png', dpi=300)
     
     return {
         'mae': mae,
@@ -201,6 +302,20 @@ def evaluate_model(model, X_test, y_test):
         'actuals': y_test
     }
 
+def clinical_accuracy(actuals, predictions, thresholds=(15, 20)):
+    """
+    Percentage of predictions within each threshold (mg/dL) of the reference
+    """
+    # asarray is a view of the Series; the subtraction is the only float buffer
+    err = np.subtract(np.asarray(actuals), predictions, dtype=np.float64)
+    np.abs(err, out=err)
+    below = np.empty(err.shape, dtype=bool)
+    counts = np.empty(len(thresholds))
+    for i, thr in enumerate(thresholds):
+        np.less(err, thr, out=below)
+        counts[i] = np.count_nonzero(below)
+    return counts / len(err) * 100
+
 def save_coefficients(model, features, output_dir='models/production'):
     """
     Save model coefficients in Arduino-compatible format
@@ -215,7 +330,7 @@ def save_coefficients(model, features, output_dir='models/production'):
     
     if isinstance(model, LinearRegression):
         coeffs = np.insert(model.coef_, 0, model.intercept_)
-        feature_names = ['intercept'] + features.tolist()
+        feature_names = ['intercept'] + list(features)
         coeff_df = pd.DataFrame({
             'feature': feature_names,
             'coefficient': coeffs
@@ -227,13 +342,18 @@ def save_coefficients(model, features, output_dir='models/production'):
         with open(header_path, 'w') as f:
             f.write("#ifndef MODEL_COEFFICIENTS_H\n")
             f.write("#define MODEL_COEFFICIENTS_H\n\n")
-            for i, row in coeff_df.iterrows():
-                f.write(f"const float {row['feature']} = {row['coefficient']:.6f};\n")
+            # Contiguous coefficient array indexed by an enum, so firmware can
+            # evaluate the model as a single dot-product loop
+            indices = [f"  IDX_{n.upper()} = {i}," for i, n in enumerate(feature_names)]
+            f.write("enum {\n" + "\n".join(indices) + "\n")
+            f.write(f"  MODEL_NUM_COEFFS = {len(coeffs)}\n}};\n\n")
+            values = ", ".join(f"{c:.6f}f" for c in coeffs)
+            f.write(f"const float MODEL_COEFFS[MODEL_NUM_COEFFS] = {{ {values} }};\n")
             f.write("\n#endif")
         
         print(f"\nSaved Arduino header to: {header_path}")
     
-    elif isinstance(model, (RandomForestRegressor, GradientBoostingRegressor)):
+    elif isinstance(model, (RandomForestRegressor, HistGradientBoostingRegressor)):
         # Save model in joblib format for possible future use
         joblib.dump(model, os.path.join(output_dir, f"{model_name}_{timestamp}.joblib"))
         print("Tree-based models require TinyML conversion for Arduino deployment")
@@ -265,22 +385,26 @@ def main():
     # Prepare features and target
     features = processed_data[['ratio', 'variability', 'slope', 'pulse_rate', 'acdc_ratio']]
     target = processed_data['glucose']
+    feature_names = features.columns.tolist()
     
     # Split data
     X_train, X_test, y_train, y_test = train_test_split(
         features, target, test_size=args.test_size, random_state=42
     )
     
-    # Standardize features
-    scaler = StandardScaler()
-    X_train = pd.DataFrame(scaler.fit_transform(X_train), columns=features.columns)
-    X_test = pd.DataFrame(scaler.transform(X_test), columns=features.columns)
+    # Standardize features in place with cached float32 stats
+    scaler = StandardScaler().fit(X_train)
+    mean = scaler.mean_.astype(np.float32)
+    inv_scale = (1.0 / scaler.scale_).astype(np.float32)
+    X_train = standardize_inplace(X_train.to_numpy(dtype=np.float32, copy=True), mean, inv_scale)
+    X_test = standardize_inplace(X_test.to_numpy(dtype=np.float32, copy=True), mean, inv_scale)
     
     # Train model
     model = train_model(X_train, y_train, args.model)
     
     # Evaluate model
-    results = evaluate_model(model, X_test, y_test)
+    fig, ax = plt.subplots(figsize=(10, 8))
+    results = evaluate_model(model, X_test, y_test, feature_names, ax)
     
     # Print evaluation results
     print("\n" + "="*60)
@@ -291,24 +415,24 @@ def main():
     print(f"R² Score: {results['r2']:.2f}")
     
     # Clinical accuracy assessment
-    within_15 = np.mean(np.abs(results['actuals'] - results['predictions']) < 15
-    within_20 = np.mean(np.abs(results['actuals'] - results['predictions']) < 20
-    print(f"Clinical Accuracy (within 15 mg/dL): {within_15*100:.1f}%")
-    print(f"Clinical Accuracy (within 20 mg/dL): {within_20*100:.1f}%")
+    thresholds = (15, 20)
+    within = clinical_accuracy(results['actuals'], results['predictions'], thresholds)
+    for thr, pct in zip(thresholds, within):
+        print(f"Clinical Accuracy (within {thr} mg/dL): {pct:.1f}%")
     
     # Save coefficients
-    save_coefficients(model, features.columns, args.output)
+    save_coefficients(model, feature_names, args.output)
     
     # Final scatter plot
-    plt.figure(figsize=(10, 8))
-    plt.scatter(results['actuals'], results['predictions'], alpha=0.5)
-    plt.plot([40, 400], [40, 400], 'r--')
-    plt.title('Actual vs Predicted Glucose Levels')
-    plt.xlabel('Reference Glucose (mg/dL)')
-    plt.ylabel('Predicted Glucose (mg/dL)')
-    plt.grid(True)
-    plt.savefig('glucose_predictions_scatter.png', dpi=300)
-    plt.close()
+    reset_figure(ax, (10, 8))
+    ax.scatter(results['actuals'], results['predictions'], alpha=0.5)
+    ax.plot([40, 400], [40, 400], 'r--')
+    ax.set_title('Actual vs Predicted Glucose Levels')
+    ax.set_xlabel('Reference Glucose (mg/dL)')
+    ax.set_ylabel('Predicted Glucose (mg/dL)')
+    ax.grid(True)
+    fig.savefig('glucose_predictions_scatter.png', dpi=300)
+    plt.close(fig)
     
     print("\nTraining complete! Visualizations saved to current directory")
 